@@ -1,22 +1,26 @@
 #! /somewhere/python3
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, _GeneratorContextManager
-from queue import Queue, Empty
 from typing import Tuple, Any, Callable, Dict, Iterator, Optional, List
-from xml.sax.saxutils import XMLGenerator
+from xml.sax.saxutils import XMLGenerator, escape, quoteattr
 import _thread
 import atexit
 import base64
+import collections
 import os
 import pathlib
 import ptpython.repl
 import pty
 import re
+import secrets
+import selectors
 import shlex
 import shutil
 import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import unicodedata
 
@@ -83,6 +87,16 @@ CHAR_TO_KEY = {
     ")": "shift-0x0B",
 }
 
+CHAR_TO_KEY_CMD = {char: "sendkey {}".format(key) for char, key in CHAR_TO_KEY.items()}
+
+# C0 and C1 control characters, for deleting them with str.translate
+CONTROL_CHARS = dict.fromkeys([*range(0x20), *range(0x7F, 0xA0)])
+
+# Seconds to wait for QEMU to answer on the monitor and for the guest to
+# connect its root shell, respectively.
+MONITOR_TIMEOUT = 300
+CONNECT_TIMEOUT = 900
+
 # Forward references
 nr_tests: int
 failed_tests: list
@@ -122,15 +136,31 @@ def create_vlan(vlan_nr: str) -> Tuple[str, str, "subprocess.Popen[bytes]", Any]
     return (vlan_nr, vde_socket, vde_process, fd)
 
 
-def retry(fn: Callable) -> None:
-    """Call the given function repeatedly, with 1 second intervals,
-    until it returns True or a timeout is reached.
+def recv_with_timeout(
+    sock: socket.socket, selector: selectors.BaseSelector, timeout: float
+) -> bytes:
+    """Receive from a socket registered with the given selector, raising an
+    exception instead of blocking forever if no data arrives within
+    `timeout` seconds.
+    """
+    if not selector.select(timeout):
+        raise Exception("no response after {} seconds".format(timeout))
+    return sock.recv(65536)
+
+
+def retry(fn: Callable, timeout: float = 900) -> None:
+    """Call the given function repeatedly, with intervals growing from
+    50 milliseconds up to 1 second, until it returns True or a timeout
+    is reached.
     """
 
-    for _ in range(900):
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while time.monotonic() < deadline:
         if fn(False):
             return
-        time.sleep(1)
+        time.sleep(delay)
+        delay = min(delay * 1.5, 1.0)
 
     if not fn(True):
         raise Exception("action timed out")
@@ -139,19 +169,35 @@ def retry(fn: Callable) -> None:
 class Logger:
     def __init__(self) -> None:
         self.logfile = os.environ.get("LOGFILE", "/dev/null")
-        self.logfile_handle = open(self.logfile, "wb")
+        self.logfile_handle = open(self.logfile, "wb", buffering=65536)
         self.xml = XMLGenerator(self.logfile_handle, encoding="utf-8")
-        self.queue: "Queue[Dict[str, str]]" = Queue(1000)
+        self.queue: "collections.deque[Dict[str, str]]" = collections.deque()
+        self.queue_lock = threading.Lock()
+        # Encoded opening tags, keyed by element name and attributes
+        self.start_tags: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], bytes] = {}
+        # Encoded XML not yet written to the log file, see flush()
+        self.pending: List[bytes] = []
+        # VMs may be started from several threads at once
+        self.pending_lock = threading.Lock()
 
         self.xml.startDocument()
         self.xml.startElement("logfile", attrs={})
 
     def close(self) -> None:
+        self.flush()
         self.xml.endElement("logfile")
         self.xml.endDocument()
         self.logfile_handle.close()
 
     def sanitise(self, message: str) -> str:
+        # str.isprintable() is False for every character in the "C"
+        # categories, so only fall back to checking each character when the
+        # cheap checks cannot rule them out.
+        if message.isprintable():
+            return message
+        message = message.translate(CONTROL_CHARS)
+        if message.isprintable():
+            return message
         return "".join(ch for ch in message if unicodedata.category(ch)[0] != "C")
 
     def maybe_prefix(self, message: str, attributes: Dict[str, str]) -> str:
@@ -159,10 +205,35 @@ class Logger:
             return "{}: {}".format(attributes["machine"], message)
         return message
 
+    def flush(self) -> None:
+        """Write out the XML collected since the last flush in one go."""
+        with self.pending_lock:
+            self.logfile_handle.writelines(self.pending)
+            self.pending.clear()
+
+    def write(self, data: bytes) -> None:
+        with self.pending_lock:
+            self.pending.append(data)
+            # Don't hold on to too much output in long-running nested blocks
+            full = len(self.pending) >= 1000
+        if full:
+            self.flush()
+
+    def start_tag(self, name: str, attributes: Dict[str, str]) -> bytes:
+        key = (name, tuple(attributes.items()))
+        tag = self.start_tags.get(key)
+        if tag is None:
+            attrs = "".join(" {}={}".format(k, quoteattr(v)) for k, v in key[1])
+            tag = "<{}{}>".format(name, attrs).encode("utf-8", "xmlcharrefreplace")
+            self.start_tags[key] = tag
+        return tag
+
     def log_line(self, message: str, attributes: Dict[str, str]) -> None:
-        self.xml.startElement("line", attributes)
-        self.xml.characters(message)
-        self.xml.endElement("line")
+        self.write(
+            self.start_tag("line", attributes)
+            + escape(message).encode("utf-8", "xmlcharrefreplace")
+            + b"</line>"
+        )
 
     def log(self, message: str, attributes: Dict[str, str] = {}) -> None:
         eprint(self.maybe_prefix(message, attributes))
@@ -170,25 +241,26 @@ class Logger:
         self.log_line(message, attributes)
 
     def enqueue(self, message: Dict[str, str]) -> None:
-        self.queue.put(message)
+        with self.queue_lock:
+            self.queue.append(message)
 
     def drain_log_queue(self) -> None:
-        try:
-            while True:
-                item = self.queue.get_nowait()
-                attributes = {"machine": item["machine"], "type": "serial"}
-                self.log_line(self.sanitise(item["msg"]), attributes)
-        except Empty:
-            pass
+        with self.queue_lock:
+            items, self.queue = self.queue, collections.deque()
+        for item in items:
+            attributes = {"machine": item["machine"], "type": "serial"}
+            self.log_line(self.sanitise(item["msg"]), attributes)
 
     @contextmanager
     def nested(self, message: str, attributes: Dict[str, str] = {}) -> Iterator[None]:
         eprint(self.maybe_prefix(message, attributes))
 
-        self.xml.startElement("nest", attrs={})
-        self.xml.startElement("head", attributes)
-        self.xml.characters(message)
-        self.xml.endElement("head")
+        self.write(
+            b"<nest>"
+            + self.start_tag("head", attributes)
+            + escape(message).encode("utf-8", "xmlcharrefreplace")
+            + b"</head>"
+        )
 
         tic = time.time()
         self.drain_log_queue()
@@ -197,10 +269,16 @@ class Logger:
         toc = time.time()
         self.log("({:.2f} seconds)".format(toc - tic))
 
-        self.xml.endElement("nest")
+        self.write(b"</nest>")
+        self.flush()
 
 
 class Machine:
+    # Extracts the machine name from a start command like run-<name>-vm
+    NAME_PATTERN = re.compile("run-(.+)-vm$")
+    # Screenshot names without a path or extension
+    WORD_PATTERN = re.compile(r"^\w+$")
+
     def __init__(self, args: Dict[str, Any]) -> None:
         if "name" in args:
             self.name = args["name"]
@@ -208,7 +286,7 @@ class Machine:
             self.name = "machine"
             cmd = args.get("startCommand", None)
             if cmd:
-                match = re.search("run-(.+)-vm$", cmd)
+                match = Machine.NAME_PATTERN.search(cmd)
                 if match:
                     self.name = match.group(1)
 
@@ -223,6 +301,7 @@ class Machine:
 
         self.state_dir = create_dir("vm-state-{}".format(self.name))
         self.shared_dir = create_dir("shared-xchg")
+        self.out_dir = os.environ.get("out", os.getcwd())
 
         self.booted = False
         self.connected = False
@@ -231,6 +310,8 @@ class Machine:
         self.monitor: Optional[socket.socket] = None
         self.logger: Logger = args["log"]
         self.allow_reboot = args.get("allowReboot", False)
+        # The last screendump that went through OCR and the text found on it
+        self.last_ocr: Optional[Tuple[bytes, str]] = None
 
     @staticmethod
     def create_startcommand(args: Dict[str, str]) -> str:
@@ -294,25 +375,40 @@ class Machine:
         my_attrs.update(attrs)
         return self.logger.nested(msg, my_attrs)
 
-    def wait_for_monitor_prompt(self) -> str:
+    def wait_for_monitor_prompt(self, prompts: int = 1) -> str:
+        """Read from the monitor until `prompts` prompts have been seen."""
         assert self.monitor is not None
-        answer = ""
+        answer = bytearray()
         while True:
-            undecoded_answer = self.monitor.recv(1024)
-            if not undecoded_answer:
+            chunk = recv_with_timeout(
+                self.monitor, self.monitor_selector, MONITOR_TIMEOUT
+            )
+            if not chunk:
                 break
-            answer += undecoded_answer.decode()
-            if answer.endswith("(qemu) "):
+            answer += chunk
+            if answer.endswith(b"(qemu) ") and answer.count(b"(qemu) ") >= prompts:
                 break
-        return answer
+        return answer.decode()
 
     def send_monitor_command(self, command: str) -> str:
-        message = ("{}\n".format(command)).encode()
+        message = command.encode() + b"\n"
         self.log("sending monitor command: {}".format(command))
         assert self.monitor is not None
-        self.monitor.send(message)
+        self.monitor.sendall(message)
         return self.wait_for_monitor_prompt()
 
+    def send_monitor_commands(self, commands: List[str]) -> str:
+        """Send several monitor commands in one go and wait for all of their
+        prompts afterwards, instead of doing a round-trip per command.
+        """
+        if not commands:
+            return ""
+        message = b"".join(command.encode() + b"\n" for command in commands)
+        self.log("sending monitor commands: {}".format(", ".join(commands)))
+        assert self.monitor is not None
+        self.monitor.sendall(message)
+        return self.wait_for_monitor_prompt(len(commands))
+
     def wait_for_unit(self, unit: str, user: Optional[str] = None) -> None:
         """Wait for a systemd unit to get into "active" state.
         Throws exceptions on "failed" and "inactive" states as well as
@@ -349,18 +445,12 @@ class Machine:
                 )
             )
 
-        line_pattern = re.compile(r"^([^=]+)=(.*)$")
-
-        def tuple_from_line(line: str) -> Tuple[str, str]:
-            match = line_pattern.match(line)
-            assert match is not None
-            return match[1], match[2]
-
-        return dict(
-            tuple_from_line(line)
-            for line in lines.split("\n")
-            if line_pattern.match(line)
-        )
+        info: Dict[str, str] = {}
+        for line in lines.split("\n"):
+            key, sep, value = line.partition("=")
+            if sep and key:
+                info[key] = value
+        return info
 
     def systemctl(self, q: str, user: Optional[str] = None) -> Tuple[int, str]:
         if user is not None:
@@ -389,24 +479,36 @@ class Machine:
     def execute(self, command: str) -> Tuple[int, str]:
         self.connect()
 
-        out_command = "( {} ); echo '|!EOF' $?\n".format(command)
-        self.shell.send(out_command.encode())
+        # A fresh nonce per command makes sure that neither the command's own
+        # output nor a left-over marker can be taken for the end of output.
+        nonce = secrets.token_hex(8)
+        out_command = "( {} ); echo '|!EOF {}' $?\n".format(command, nonce)
+        eof_mark = "|!EOF {} ".format(nonce).encode()
+        self.shell.sendall(out_command.encode())
 
-        output = ""
-        status_code_pattern = re.compile(r"(.*)\|\!EOF\s+(\d+)")
+        output = bytearray()
+        # Only scan data that has not been looked at yet, keeping enough of
+        # the previous tail to catch a marker split across two reads.
+        start = 0
 
         while True:
-            chunk = self.shell.recv(4096).decode(errors="ignore")
-            match = status_code_pattern.match(chunk)
-            if match:
-                output += match[1]
-                status_code = int(match[2])
-                return (status_code, output)
+            chunk = self.shell.recv(65536)
+            if not chunk:
+                raise Exception("connection to the guest shell was closed")
             output += chunk
+            eof = output.find(eof_mark, start)
+            if eof == -1:
+                start = max(0, len(output) - len(eof_mark) + 1)
+                continue
+            start = eof
+            end = output.find(b"\n", eof)
+            if end != -1:
+                status_code = int(output[eof + len(eof_mark) : end])
+                return (status_code, output[:eof].decode(errors="ignore"))
 
     def succeed(self, *commands: str) -> str:
         """Execute each command and check that it succeeds."""
-        output = ""
+        outputs = []
         for command in commands:
             with self.nested("must succeed: {}".format(command)):
                 (status, out) = self.execute(command)
@@ -415,8 +517,8 @@ class Machine:
                     raise Exception(
                         "command `{}` failed (exit code {})".format(command, status)
                     )
-                output += out
-        return output
+                outputs.append(out)
+        return "".join(outputs)
 
     def fail(self, *commands: str) -> None:
         """Execute each command and check that it fails."""
@@ -465,6 +567,8 @@ class Machine:
         with self.nested("waiting for the VM to power off"):
             sys.stdout.flush()
             self.process.wait()
+            self.monitor_selector.close()
+            self.shell_selector.close()
 
             self.pid = None
             self.booted = False
@@ -497,8 +601,12 @@ class Machine:
 
     def send_chars(self, chars: List[str]) -> None:
         with self.nested("sending keys ‘{}‘".format(chars)):
-            for char in chars:
-                self.send_key(char)
+            self.send_monitor_commands(
+                [
+                    CHAR_TO_KEY_CMD.get(char) or "sendkey {}".format(char)
+                    for char in chars
+                ]
+            )
 
     def wait_for_file(self, filename: str) -> None:
         """Waits until the file exists in machine's file system."""
@@ -542,8 +650,7 @@ class Machine:
             self.start()
 
             tic = time.time()
-            self.shell.recv(1024)
-            # TODO: Timeout
+            recv_with_timeout(self.shell, self.shell_selector, CONNECT_TIMEOUT)
             toc = time.time()
 
             self.log("connected to guest root shell")
@@ -551,10 +658,8 @@ class Machine:
             self.connected = True
 
     def screenshot(self, filename: str) -> None:
-        out_dir = os.environ.get("out", os.getcwd())
-        word_pattern = re.compile(r"^\w+$")
-        if word_pattern.match(filename):
-            filename = os.path.join(out_dir, "{}.png".format(filename))
+        if Machine.WORD_PATTERN.match(filename):
+            filename = os.path.join(self.out_dir, "{}.png".format(filename))
         tmp = "{}.ppm".format(filename)
 
         with self.nested(
@@ -562,7 +667,8 @@ class Machine:
             {"image": os.path.basename(filename)},
         ):
             self.send_monitor_command("screendump {}".format(tmp))
-            ret = subprocess.run("pnmtopng {} > {}".format(tmp, filename), shell=True)
+            with open(filename, "wb") as png:
+                ret = subprocess.run(["pnmtopng", tmp], stdout=png)
             os.unlink(tmp)
             if ret.returncode != 0:
                 raise Exception("Cannot convert screenshot")
@@ -608,7 +714,7 @@ class Machine:
         all the VMs (using a temporary directory).
         """
         # Compute the source, target, and intermediate shared file names
-        out_dir = pathlib.Path(os.environ.get("out", os.getcwd()))
+        out_dir = pathlib.Path(self.out_dir)
         vm_src = pathlib.Path(source)
         with tempfile.TemporaryDirectory(dir=self.shared_dir) as shared_td:
             shared_temp = pathlib.Path(shared_td)
@@ -643,29 +749,53 @@ class Machine:
             + "-contrast -normalize -despeckle -type grayscale "
             + "-sharpen 1 -posterize 3 -negate -gamma 100 "
             + "-blur 1x65535"
-        )
+        ).split()
 
-        tess_args = "-c debug_file=/dev/null --psm 11 --oem 2"
+        tess_args = "-c debug_file=/dev/null --psm 11 --oem 2".split()
 
         with self.nested("performing optical character recognition"):
             with tempfile.NamedTemporaryFile() as tmpin:
                 self.send_monitor_command("screendump {}".format(tmpin.name))
 
-                cmd = "convert {} {} tiff:- | tesseract - - {}".format(
-                    magick_args, tmpin.name, tess_args
+                # OCR is slow, and while polling the screen often doesn't
+                # change between attempts
+                with open(tmpin.name, "rb") as dump:
+                    screen = dump.read()
+                if self.last_ocr is not None and self.last_ocr[0] == screen:
+                    self.log("screen unchanged, reusing previous OCR result")
+                    return self.last_ocr[1]
+
+                convert = subprocess.Popen(
+                    ["convert", *magick_args, tmpin.name, "tiff:-"],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
                 )
-                ret = subprocess.run(cmd, shell=True, capture_output=True)
-                if ret.returncode != 0:
+                tesseract = subprocess.Popen(
+                    ["tesseract", "-", "-", *tess_args],
+                    stdin=convert.stdout,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                )
+                assert convert.stdout is not None
+                # Let convert get SIGPIPE if tesseract exits early
+                convert.stdout.close()
+                stdout, _ = tesseract.communicate()
+                convert.wait()
+                if tesseract.returncode != 0:
                     raise Exception(
-                        "OCR failed with exit code {}".format(ret.returncode)
+                        "OCR failed with exit code {}".format(tesseract.returncode)
                     )
 
-                return ret.stdout.decode("utf-8")
+                text = stdout.decode("utf-8")
+                self.last_ocr = (screen, text)
+                return text
 
     def wait_for_text(self, regex: str) -> None:
+        pattern = re.compile(regex)
+
         def screen_matches(last: bool) -> bool:
             text = self.get_screen_text()
-            matches = re.search(regex, text) is not None
+            matches = pattern.search(text) is not None
 
             if last and not matches:
                 self.log("Last OCR attempt failed. Text was: {}".format(text))
@@ -676,8 +806,7 @@ class Machine:
             retry(screen_matches)
 
     def send_key(self, key: str) -> None:
-        key = CHAR_TO_KEY.get(key, key)
-        self.send_monitor_command("sendkey {}".format(key))
+        self.send_monitor_command(CHAR_TO_KEY_CMD.get(key) or "sendkey {}".format(key))
 
     def start(self) -> None:
         if self.booted:
@@ -686,8 +815,10 @@ class Machine:
         self.log("starting vm")
 
         def create_socket(path: str) -> socket.socket:
-            if os.path.exists(path):
+            try:
                 os.unlink(path)
+            except FileNotFoundError:
+                pass
             s = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM)
             s.bind(path)
             s.listen(1)
@@ -727,7 +858,7 @@ class Machine:
 
         self.process = subprocess.Popen(
             self.script,
-            bufsize=1,
+            bufsize=65536,
             stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
@@ -738,6 +869,11 @@ class Machine:
         self.monitor, _ = self.monitor_socket.accept()
         self.shell, _ = self.shell_socket.accept()
 
+        self.monitor_selector = selectors.DefaultSelector()
+        self.monitor_selector.register(self.monitor, selectors.EVENT_READ)
+        self.shell_selector = selectors.DefaultSelector()
+        self.shell_selector.register(self.shell, selectors.EVENT_READ)
+
         def process_serial_output() -> None:
             for _line in self.process.stdout:
                 # Ignore undecodable bytes that may occur in boot menus
@@ -777,12 +913,10 @@ class Machine:
         def check_x(_: Any) -> bool:
             cmd = (
                 "journalctl -b SYSLOG_IDENTIFIER=systemd | "
-                + 'grep "Reached target Current graphical"'
+                + 'grep "Reached target Current graphical" && '
+                + "[ -e /tmp/.X11-unix/X0 ]"
             )
             status, _ = self.execute(cmd)
-            if status != 0:
-                return False
-            status, _ = self.execute("[ -e /tmp/.X11-unix/X0 ]")
             return status == 0
 
         with self.nested("waiting for the X11 server"):
@@ -843,8 +977,9 @@ def create_machine(args: Dict[str, Any]) -> Machine:
 def start_all() -> None:
     global machines
     with log.nested("starting all VMs"):
-        for machine in machines:
-            machine.start()
+        # Starting a VM is mostly waiting for QEMU, so do it concurrently
+        with ThreadPoolExecutor(max_workers=len(machines) or 1) as executor:
+            list(executor.map(Machine.start, machines))
 
 
 def join_all() -> None:
@@ -911,7 +1046,12 @@ def subtest(name: str) -> Iterator[None]:
 if __name__ == "__main__":
     log = Logger()
 
-    vlan_nrs = list(dict.fromkeys(os.environ.get("VLANS", "").split()))
+    vlan_nrs: List[str] = []
+    seen_vlans = set()
+    for vlan_nr in os.environ.get("VLANS", "").split():
+        if vlan_nr not in seen_vlans:
+            seen_vlans.add(vlan_nr)
+            vlan_nrs.append(vlan_nr)
     vde_sockets = [create_vlan(v) for v in vlan_nrs]
     for nr, vde_socket, _, _ in vde_sockets:
         os.environ["QEMU_VDE_SOCKET_{}".format(nr)] = vde_socket